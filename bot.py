@@ -4,18 +4,25 @@ import logging
 import sqlite3
 import warnings
 import uuid
+import json
+import traceback
+from collections import Counter, OrderedDict, deque
+from datetime import timedelta
 from pathlib import Path
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from urllib.parse import urlparse, parse_qs
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.constants import ParseMode, ChatType
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import (
     Application,
+    BaseRateLimiter,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
     filters,
     ContextTypes
 )
-from threading import Lock, Thread
+from threading import Lock, Thread, get_ident
 from requests.exceptions import ConnectionError, RequestException
 from httpx import ReadError
 import requests
@@ -49,7 +56,21 @@ CONFIG = {
     "ADMIN_ID": 8315454125,
     "DB_FILE": "users.db",
     "DATA_DIR": "data",
-    "USERS_FILE": "users.txt"
+    "USERS_FILE": "users.txt",
+    "LOOP_LAG_INTERVAL": 0.5,  # Seconds between event loop heartbeats
+    "LOOP_STALL_THRESHOLD": 1.0,  # Lag in seconds reported as a stall
+    "PROFILE_SAMPLE_INTERVAL": 0.01,  # Seconds between profiler samples
+    "PROFILE_MAX_SECONDS": 60,
+    "PROFILE_TOKEN": None,  # Enables /profile on the HTTP server when set
+    "HISTORY_FLUSH_INTERVAL": 5,  # Seconds between batched generation writes
+    "SEND_GLOBAL_PER_SECOND": 30,
+    "SEND_CHAT_PER_SECOND": 1,
+    "SEND_CHAT_BURST": 3,
+    "SEND_GROUP_PER_MINUTE": 20,  # Budget for GROUP_CHAT_ID
+    "SEND_GROUP_BURST": 5,
+    "SEND_PRIORITY_RESERVE": 3,  # Global tokens each priority class leaves for the classes above it
+    "SEND_TOPIC_QUEUE_LIMIT": 100,  # Oldest waiting topic mirrors are dropped past this
+    "SEND_MAX_RETRIES": 3  # RetryAfter retries before a send is dropped
 }
 CONFIG["BOT_USER_ID"] = int(CONFIG["BOT_TOKEN"].split(':')[0])
 
@@ -77,6 +98,16 @@ LANGUAGE_EN = {
     "broadcast_success": "🎉 Broadcast sent to {count} users! 📬",
     "broadcast_canceled": "❌ Broadcast canceled.",
     "broadcast_error": "❌ Invalid command. Use: /bro <message> [-<btnname>:<btnlink>] [--<imagelink>]",
+    "profile_started": "⏱️ Profiling event loop for {}s...",
+    "profile_busy": "⚠️ A profile is already running.",
+    "profile_error": "❌ Invalid command. Use: /profile [seconds]",
+    "profile_done": "🔥 Collapsed stacks: {} samples over {}s",
+    "history_empty": "No generations yet. Use /gen to create one! 📸",
+    "history_item": "🖼️ Prompt: {prompt}\n📅 {date} | 📐 {dimension} | 💾 {size} KB",
+    "history_newer": "⬅️ Newer",
+    "history_older": "Older ➡️",
+    "history_resend": "🔁 Resend",
+    "history_not_found": "That image is no longer in your history. 🚫",
 }
 
 # User states
@@ -87,6 +118,213 @@ STATE_IMPROVE = "awaiting_improve"
 # Thread-safe lock for in-memory operations
 DATA_LOCK = Lock()
 USER_STATE = {}  # User states for conversation flow
+TOPIC_LOCKS = {}  # Per-user asyncio locks so concurrent updates create one topic
+
+# Event loop monitoring state
+LOOP_STATE = {"thread_id": None, "expected_wake": None, "reported": None, "lag": 0.0, "max_lag": 0.0, "stalls": 0}
+PROFILE_LOCK = Lock()  # Only one sampling profile at a time
+
+# Long-running monitor/flusher tasks, cancelled on stop
+PERIODIC_TASKS = set()
+
+# Generations waiting to be written in the next batch
+GENERATION_QUEUE = []
+
+# Send priorities, highest first
+PRIORITY_USER = 0  # Replies to users
+PRIORITY_TOPIC = 1  # Mirroring into GROUP_CHAT_ID topics
+PRIORITY_BROADCAST = 2
+PRIORITY_NAMES = {PRIORITY_USER: "user", PRIORITY_TOPIC: "topic", PRIORITY_BROADCAST: "broadcast"}
+SEND_ENDPOINTS = {"sendMessage", "sendPhoto", "sendDocument", "forwardMessage"}  # Counted in stats["sent"]
+
+class SendScheduler(BaseRateLimiter):
+    """Grant Telegram requests by priority within global, group and per-chat budgets.
+
+    Pass a priority as rate_limit_args on context.bot calls; requests without one
+    (including Message shortcuts like reply_text) are user-facing.
+    """
+
+    def __init__(self):
+        # Priority -> chat ID -> waiting futures, in arrival order
+        self.queues = {priority: OrderedDict() for priority in PRIORITY_NAMES}
+        self.depth = Counter()
+        self.buckets = {}  # Budget key -> (tokens, last refill time)
+        self.blocked_until = {}  # Chat ID -> time its RetryAfter expires
+        self.sent = Counter()
+        self.retries = 0
+        self.dropped = 0
+        self.wakeup = None
+        self.dispatcher = None
+
+    async def initialize(self) -> None:
+        self.wakeup = asyncio.Event()
+        self.dispatcher = asyncio.get_running_loop().create_task(self.dispatch())
+
+    async def shutdown(self) -> None:
+        if self.dispatcher:
+            self.dispatcher.cancel()
+        for chats in self.queues.values():
+            for futures in chats.values():
+                for future in futures:
+                    future.cancel()
+            chats.clear()
+        self.depth.clear()
+
+    def budget(self, key):
+        """Return (tokens per second, burst) for a budget key."""
+        if key == "global":
+            return CONFIG["SEND_GLOBAL_PER_SECOND"], CONFIG["SEND_GLOBAL_PER_SECOND"]
+        if key == CONFIG["GROUP_CHAT_ID"]:
+            return CONFIG["SEND_GROUP_PER_MINUTE"] / 60, CONFIG["SEND_GROUP_BURST"]
+        return CONFIG["SEND_CHAT_PER_SECOND"], CONFIG["SEND_CHAT_BURST"]
+
+    def tokens(self, key, now):
+        """Refill and return the tokens available for a budget key."""
+        rate, burst = self.budget(key)
+        tokens, updated = self.buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        self.buckets[key] = (tokens, now)
+        return tokens
+
+    def wait_time(self, key, now, reserve=0):
+        """Seconds until a budget key has a token to spare beyond reserve."""
+        blocked = self.blocked_until.get(key, 0) - now
+        if blocked > 0:
+            return blocked
+        missing = 1 + reserve - self.tokens(key, now)
+        return max(0, missing / self.budget(key)[0])
+
+    def take(self, key):
+        tokens, updated = self.buckets[key]
+        self.buckets[key] = (tokens - 1, updated)
+
+    def pop(self, priority, chat_id):
+        """Remove and return the oldest waiting future for a chat."""
+        chats = self.queues[priority]
+        future = chats[chat_id].popleft()
+        if not chats[chat_id]:
+            del chats[chat_id]
+        self.depth[priority] -= 1
+        return future
+
+    def grant_ready(self):
+        """Grant waiting requests in priority order; return seconds until the next may be granted.
+
+        Each pass touches every waiting chat at most once, however many
+        requests are queued for it.
+        """
+        now = time.monotonic()
+        next_ready = None
+        for priority, chats in self.queues.items():
+            reserve = priority * CONFIG["SEND_PRIORITY_RESERVE"]
+            global_wait = 0
+            for chat_id in list(chats):
+                while chat_id in chats:
+                    if chats[chat_id][0].done():
+                        self.pop(priority, chat_id)
+                        continue
+                    global_wait = self.wait_time("global", now, reserve)
+                    wait = global_wait or self.wait_time(chat_id, now)
+                    if wait:
+                        next_ready = wait if next_ready is None else min(next_ready, wait)
+                        break
+                    self.take("global")
+                    self.take(chat_id)
+                    self.pop(priority, chat_id).set_result(None)
+                if global_wait:
+                    break
+        return next_ready
+
+    def drop_oldest(self, priority):
+        """Fail the oldest waiting request of a priority class to make room."""
+        chat_id = next(iter(self.queues[priority]))
+        future = self.pop(priority, chat_id)
+        if not future.done():
+            future.set_exception(TelegramError(f"Dropped from full {PRIORITY_NAMES[priority]} send queue"))
+        self.dropped += 1
+
+    def prune(self):
+        """Forget full buckets and expired RetryAfter blocks."""
+        now = time.monotonic()
+        for key in list(self.buckets):
+            if self.tokens(key, now) >= self.budget(key)[1]:
+                del self.buckets[key]
+        for key, until in list(self.blocked_until.items()):
+            if until <= now:
+                del self.blocked_until[key]
+
+    async def dispatch(self):
+        """Grant requests as budgets refill or new requests arrive."""
+        while True:
+            self.wakeup.clear()
+            next_ready = self.grant_ready()
+            if next_ready is None and not any(self.queues.values()):
+                self.prune()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), next_ready)
+            except asyncio.TimeoutError:
+                pass
+
+    async def acquire(self, priority, chat_id, retry=False):
+        """Wait until a request to chat_id may be sent; retries keep their place at the front."""
+        if priority == PRIORITY_TOPIC and self.depth[priority] >= CONFIG["SEND_TOPIC_QUEUE_LIMIT"]:
+            self.drop_oldest(priority)
+        future = asyncio.get_running_loop().create_future()
+        futures = self.queues[priority].setdefault(chat_id, deque())
+        if retry:
+            futures.appendleft(future)
+        else:
+            futures.append(future)
+        self.depth[priority] += 1
+        self.wakeup.set()
+        await future
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        """Wait for a send slot, then run the request, retrying on RetryAfter."""
+        priority = rate_limit_args if rate_limit_args in self.queues else PRIORITY_USER
+        chat_id = data.get("chat_id")
+        for attempt in range(CONFIG["SEND_MAX_RETRIES"] + 1):
+            if chat_id is not None:
+                await self.acquire(priority, chat_id, retry=attempt > 0)
+            try:
+                result = await callback(*args, **kwargs)
+                if endpoint in SEND_ENDPOINTS:
+                    self.sent[priority] += 1
+                return result
+            except RetryAfter as e:
+                if attempt == CONFIG["SEND_MAX_RETRIES"]:
+                    raise
+                delay = e.retry_after
+                if isinstance(delay, timedelta):
+                    delay = delay.total_seconds()
+                self.retries += 1
+                logger.warning(f"Flood control on {endpoint} for chat {chat_id}, retrying in {delay}s")
+                if chat_id is None:
+                    await asyncio.sleep(delay)
+                else:
+                    self.blocked_until[chat_id] = time.monotonic() + delay
+
+    def stats(self):
+        """Return queue depths and counters for monitoring."""
+        now = time.monotonic()
+        return {
+            "queued": {name: self.depth[priority] for priority, name in PRIORITY_NAMES.items()},
+            "sent": {name: self.sent[priority] for priority, name in PRIORITY_NAMES.items()},
+            "retry_after": self.retries,
+            "dropped": self.dropped,
+            "blocked_chats": sum(1 for until in list(self.blocked_until.values()) if until > now)
+        }
+
+SEND_SCHEDULER = SendScheduler()
+
+# Fire-and-forget send tasks, cancelled on stop
+BACKGROUND_SENDS = set()
+
+def send_in_background(coro):
+    """Run a send coroutine without blocking the handler; cancelled in post_stop."""
+    task = asyncio.get_running_loop().create_task(coro)
+    BACKGROUND_SENDS.add(task)
+    task.add_done_callback(BACKGROUND_SENDS.discard)
 
 # Database and file handling
 def manage_user_data(user_id, update_usage=None, update_topic_id=None):
@@ -141,6 +379,22 @@ def init_db():
                     topic_id INTEGER
                 )
             """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS generations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    prompt TEXT,
+                    improve INTEGER,
+                    dimension TEXT,
+                    image_url TEXT,
+                    file_id TEXT,
+                    image_size REAL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_generations_user_created ON generations (user_id, created_at)"
+            )
             conn.commit()
         logger.info("Database initialized")
     except Exception as e:
@@ -200,21 +454,101 @@ def get_user_by_topic(topic_id):
         logger.error(f"Get user by topic error: {e}")
         return None
 
-async def forward_to_topic(update: Update, context: ContextTypes, topic_id):
-    """Forward user's message to topic."""
-    user_id = update.effective_user.id
+def record_generation(user_id, prompt, improve, dimension, image_url, file_id, image_size):
+    """Queue a successful generation for the next batched write."""
+    with DATA_LOCK:
+        GENERATION_QUEUE.append(
+            (user_id, prompt, int(improve), dimension, image_url, file_id, image_size, time.time())
+        )
+
+def flush_generations():
+    """Write queued generations to the database in one transaction."""
+    with DATA_LOCK:
+        batch = GENERATION_QUEUE[:]
+        GENERATION_QUEUE.clear()
+    if not batch:
+        return
+    try:
+        with sqlite3.connect(CONFIG["DB_FILE"]) as conn:
+            conn.executemany(
+                """INSERT INTO generations
+                   (user_id, prompt, improve, dimension, image_url, file_id, image_size, created_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                batch
+            )
+            conn.commit()
+        logger.info(f"Flushed {len(batch)} generations")
+    except Exception as e:
+        logger.error(f"Flush generations error: {e}")
+        with DATA_LOCK:
+            GENERATION_QUEUE[:0] = batch
+
+async def flush_generations_periodically():
+    """Flush queued generations every HISTORY_FLUSH_INTERVAL seconds."""
+    while True:
+        await asyncio.sleep(CONFIG["HISTORY_FLUSH_INTERVAL"])
+        if GENERATION_QUEUE:
+            await asyncio.get_running_loop().run_in_executor(None, flush_generations)
+
+GENERATION_COLUMNS = ("id", "prompt", "improve", "dimension", "image_url", "file_id", "image_size", "created_at")
+
+def get_generation_page(user_id, after=None, newer=False):
+    """Get the generation next to a (created_at, id) keyset cursor, plus one lookahead row."""
+    sql = f"SELECT {', '.join(GENERATION_COLUMNS)} FROM generations WHERE user_id = ?"
+    params = [user_id]
+    if after:
+        created_at, generation_id = after
+        op, order = (">", "ASC") if newer else ("<", "DESC")
+        sql += f" AND (created_at, id) {op} (?, ?)"
+        params += [created_at, generation_id]
+    else:
+        order = "DESC"
+    sql += f" ORDER BY created_at {order}, id {order} LIMIT 2"
+    try:
+        with sqlite3.connect(CONFIG["DB_FILE"]) as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql, params)
+            return [dict(zip(GENERATION_COLUMNS, row)) for row in cursor.fetchall()]
+    except Exception as e:
+        logger.error(f"Get generation page error for user {user_id}: {e}")
+        return []
+
+def get_generation(user_id, generation_id):
+    """Get a single generation owned by user_id."""
+    try:
+        with sqlite3.connect(CONFIG["DB_FILE"]) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"SELECT {', '.join(GENERATION_COLUMNS)} FROM generations WHERE id = ? AND user_id = ?",
+                (generation_id, user_id)
+            )
+            result = cursor.fetchone()
+            return dict(zip(GENERATION_COLUMNS, result)) if result else None
+    except Exception as e:
+        logger.error(f"Get generation {generation_id} error: {e}")
+        return None
+
+async def deliver_forward_to_topic(context: ContextTypes, topic_id, user_id, message_id):
+    """Forward a user's message to topic at mirroring priority."""
     try:
         await context.bot.forward_message(
             chat_id=CONFIG["GROUP_CHAT_ID"],
             message_thread_id=topic_id,
             from_chat_id=user_id,
-            message_id=update.message.message_id
+            message_id=message_id,
+            rate_limit_args=PRIORITY_TOPIC
         )
     except Exception as e:
         logger.error(f"Forward to topic {topic_id} error: {e}")
 
-async def send_to_topic(context: ContextTypes, topic_id, text=None, photo=None, caption=None, reply_markup=None, parse_mode=None):
-    """Send bot's reply to topic."""
+def forward_to_topic(update: Update, context: ContextTypes, topic_id):
+    """Forward user's message to topic in the background."""
+    send_in_background(
+        deliver_forward_to_topic(context, topic_id, update.effective_user.id, update.message.message_id)
+    )
+
+async def deliver_to_topic(context: ContextTypes, topic_id, text=None, photo=None, caption=None, reply_markup=None, parse_mode=None):
+    """Send bot's reply to topic at mirroring priority."""
     try:
         if photo:
             await context.bot.send_photo(
@@ -223,7 +557,8 @@ async def send_to_topic(context: ContextTypes, topic_id, text=None, photo=None,
                 photo=photo,
                 caption=caption,
                 reply_markup=reply_markup,
-                parse_mode=parse_mode
+                parse_mode=parse_mode,
+                rate_limit_args=PRIORITY_TOPIC
             )
         else:
             await context.bot.send_message(
@@ -231,50 +566,58 @@ async def send_to_topic(context: ContextTypes, topic_id, text=None, photo=None,
                 message_thread_id=topic_id,
                 text=text,
                 reply_markup=reply_markup,
-                parse_mode=parse_mode
+                parse_mode=parse_mode,
+                rate_limit_args=PRIORITY_TOPIC
             )
     except Exception as e:
         logger.error(f"Send to topic {topic_id} error: {e}")
 
+def send_to_topic(context: ContextTypes, topic_id, text=None, photo=None, caption=None, reply_markup=None, parse_mode=None):
+    """Send bot's reply to topic in the background so user replies never wait on mirroring."""
+    send_in_background(
+        deliver_to_topic(context, topic_id, text, photo, caption, reply_markup, parse_mode)
+    )
+
 async def create_user_topic(user, context: ContextTypes):
-    """Create a topic for a user in the group and post their info."""
-    user_id = user.id
-    user_data = manage_user_data(user_id)
-    
-    if user_data["topic_id"]:
-        return user_data["topic_id"]
-    
-    try:
-        # Create a new topic in the group
-        topic = await context.bot.create_forum_topic(
-            chat_id=CONFIG["GROUP_CHAT_ID"],
-            name=f"User {user.full_name or user_id}"
-        )
-        topic_id = topic.message_thread_id
-        manage_user_data(user_id, update_topic_id=topic_id)
+    """Create a topic for a user in the group and post their info, once per user."""
+    async with TOPIC_LOCKS.setdefault(user.id, asyncio.Lock()):
+        user_id = user.id
+        user_data = manage_user_data(user_id)
+        
+        if user_data["topic_id"]:
+            return user_data["topic_id"]
         
-        # Get user profile photo
-        profile_photo = None
         try:
-            photos = await context.bot.get_user_profile_photos(user_id, limit=1)
-            if photos.photos:
-                profile_photo = photos.photos[0][-1].file_id
-        except Exception as e:
-            logger.error(f"Error fetching profile photo for user {user_id}: {e}")
+            # Create a new topic in the group
+            topic = await context.bot.create_forum_topic(
+                chat_id=CONFIG["GROUP_CHAT_ID"],
+                name=f"User {user.full_name or user_id}"
+            )
+            topic_id = topic.message_thread_id
+            manage_user_data(user_id, update_topic_id=topic_id)
         
-        # Post user info with hyperlink
-        user_info = f"User Info:\nFull Name: {user.full_name}\n<a href=\"tg://user?id={user_id}\">User ID: {user_id}</a>"
+            # Get user profile photo
+            profile_photo = None
+            try:
+                photos = await context.bot.get_user_profile_photos(user_id, limit=1)
+                if photos.photos:
+                    profile_photo = photos.photos[0][-1].file_id
+            except Exception as e:
+                logger.error(f"Error fetching profile photo for user {user_id}: {e}")
         
-        if profile_photo:
-            await send_to_topic(context, topic_id, photo=profile_photo, caption=user_info, parse_mode=ParseMode.HTML)
-        else:
-            await send_to_topic(context, topic_id, text=user_info, parse_mode=ParseMode.HTML)
+            # Post user info with hyperlink
+            user_info = f"User Info:\nFull Name: {user.full_name}\n<a href=\"tg://user?id={user_id}\">User ID: {user_id}</a>"
         
-        logger.info(f"Created topic {topic_id} for user {user_id}")
-        return topic_id
-    except Exception as e:
-        logger.error(f"Error creating topic for user {user_id}: {e}")
-        return None
+            if profile_photo:
+                send_to_topic(context, topic_id, photo=profile_photo, caption=user_info, parse_mode=ParseMode.HTML)
+            else:
+                send_to_topic(context, topic_id, text=user_info, parse_mode=ParseMode.HTML)
+        
+            logger.info(f"Created topic {topic_id} for user {user_id}")
+            return topic_id
+        except Exception as e:
+            logger.error(f"Error creating topic for user {user_id}: {e}")
+            return None
 
 def get_user_language(user_id):
     """Return English settings."""
@@ -290,14 +633,14 @@ async def start_command(update: Update, context: ContextTypes) -> None:
         manage_user_data(user_id)  # Ensure user is in db
         topic_id = await create_user_topic(update.effective_user, context)
         
-        await forward_to_topic(update, context, topic_id)
+        forward_to_topic(update, context, topic_id)
         
         keyboard = [[InlineKeyboardButton("Support ⭐", url=CONFIG["SUPPORT_URL"])]]
         await update.message.reply_text(
             lang["welcome"],
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
-        await send_to_topic(context, topic_id, text=lang["welcome"], reply_markup=InlineKeyboardMarkup(keyboard))
+        send_to_topic(context, topic_id, text=lang["welcome"], reply_markup=InlineKeyboardMarkup(keyboard))
     except Exception as e:
         logger.error(f"Error in start_command for user {user_id}: {e}")
         await update.message.reply_text(lang["error"].format("Unexpected error occurred. Please try again."))
@@ -321,12 +664,12 @@ async def users_command(update: Update, context: ContextTypes) -> None:
         f.write(f"Number of users: {num_users}\n\nUser IDs:\n{user_ids}")
     
     try:
-        with filename.open("rb") as f:
-            await context.bot.send_document(
-                chat_id=user_id,
-                document=f,
-                caption=lang["num_users"].format(num_users, user_ids)
-            )
+        await context.bot.send_document(
+            chat_id=user_id,
+            document=filename.read_bytes(),
+            filename=CONFIG["USERS_FILE"],
+            caption=lang["num_users"].format(num_users, user_ids)
+        )
         logger.info(f"users.txt sent to admin {user_id}")
     except Exception as e:
         logger.error(f"Error sending users.txt: {e}")
@@ -427,32 +770,44 @@ async def handle_broadcast_callback(update: Update, context: ContextTypes) -> No
         return
     
     if action == "yes":
-        all_users = get_all_users()
-        count = 0
-        keyboard = [[InlineKeyboardButton(broadcast_data["btn_name"], url=broadcast_data["btn_link"])]] if broadcast_data["btn_name"] and broadcast_data["btn_link"] else None
-        
-        for user in all_users:
-            try:
-                if broadcast_data["image_url"]:
-                    await context.bot.send_photo(
-                        chat_id=user["user_id"],
-                        photo=broadcast_data["image_url"],
-                        caption=broadcast_data["message"],
-                        reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None
-                    )
-                else:
-                    await context.bot.send_message(
-                        chat_id=user["user_id"],
-                        text=broadcast_data["message"],
-                        reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None
-                    )
-                count += 1
-                await asyncio.sleep(0.05)
-            except Exception as e:
-                logger.error(f"Broadcast failed for user {user['user_id']}: {e}")
-        
         del context.bot_data[broadcast_id]
-        await query.message.edit_text(lang["broadcast_success"].format(count=count))
+        send_in_background(deliver_broadcast(context, query.message, broadcast_data))
+
+async def send_broadcast(context: ContextTypes, user_id, broadcast_data, reply_markup):
+    """Send a broadcast to one user at broadcast priority; return whether it was delivered."""
+    try:
+        if broadcast_data["image_url"]:
+            await context.bot.send_photo(
+                chat_id=user_id,
+                photo=broadcast_data["image_url"],
+                caption=broadcast_data["message"],
+                reply_markup=reply_markup,
+                rate_limit_args=PRIORITY_BROADCAST
+            )
+        else:
+            await context.bot.send_message(
+                chat_id=user_id,
+                text=broadcast_data["message"],
+                reply_markup=reply_markup,
+                rate_limit_args=PRIORITY_BROADCAST
+            )
+        return True
+    except Exception as e:
+        logger.error(f"Broadcast failed for user {user_id}: {e}")
+        return False
+
+async def deliver_broadcast(context: ContextTypes, approval_message, broadcast_data):
+    """Queue a broadcast to all users and report the delivered count to the admin."""
+    lang = get_user_language(broadcast_data["admin_id"])
+    keyboard = [[InlineKeyboardButton(broadcast_data["btn_name"], url=broadcast_data["btn_link"])]] if broadcast_data["btn_name"] and broadcast_data["btn_link"] else None
+    reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
+    
+    results = await asyncio.gather(*(
+        send_broadcast(context, user["user_id"], broadcast_data, reply_markup)
+        for user in get_all_users()
+    ))
+    count = sum(results)
+    await approval_message.edit_text(lang["broadcast_success"].format(count=count))
 
 async def gen_command(update: Update, context: ContextTypes) -> None:
     """Handle /gen."""
@@ -463,11 +818,107 @@ async def gen_command(update: Update, context: ContextTypes) -> None:
     manage_user_data(user_id)  # Ensure user is in db
     topic_id = await create_user_topic(update.effective_user, context)
     
-    await forward_to_topic(update, context, topic_id)
+    forward_to_topic(update, context, topic_id)
     
     USER_STATE[user_id] = STATE_PROMPT
     await update.message.reply_text(lang["prompt"])
-    await send_to_topic(context, topic_id, text=lang["prompt"])
+    send_to_topic(context, topic_id, text=lang["prompt"])
+
+def history_caption(lang, generation):
+    """Format a stored generation for display."""
+    return lang["history_item"].format(
+        prompt=generation["prompt"],
+        date=time.strftime("%Y-%m-%d %H:%M", time.localtime(generation["created_at"])),
+        dimension=generation["dimension"],
+        size=generation["image_size"]
+    )
+
+def history_keyboard(lang, generation, has_newer, has_older):
+    """Build next/prev and resend buttons for a history page."""
+    cursor = f"{generation['created_at']!r}_{generation['id']}"
+    nav = []
+    if has_newer:
+        nav.append(InlineKeyboardButton(lang["history_newer"], callback_data=f"hist_new_{cursor}"))
+    if has_older:
+        nav.append(InlineKeyboardButton(lang["history_older"], callback_data=f"hist_old_{cursor}"))
+    keyboard = [nav] if nav else []
+    keyboard.append([InlineKeyboardButton(lang["history_resend"], callback_data=f"hist_send_{generation['id']}")])
+    return InlineKeyboardMarkup(keyboard)
+
+async def history_command(update: Update, context: ContextTypes) -> None:
+    """Handle /history to browse past generations."""
+    user_id = update.effective_user.id
+    lang = get_user_language(user_id)
+    logger.info(f"User {user_id} opened /history")
+    
+    manage_user_data(user_id)  # Ensure user is in db
+    topic_id = await create_user_topic(update.effective_user, context)
+    
+    forward_to_topic(update, context, topic_id)
+    
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, flush_generations)
+    page = await loop.run_in_executor(None, get_generation_page, user_id)
+    if not page:
+        await update.message.reply_text(lang["history_empty"])
+        return
+    
+    generation = page[0]
+    await update.message.reply_photo(
+        photo=generation["file_id"] or generation["image_url"],
+        caption=history_caption(lang, generation),
+        reply_markup=history_keyboard(lang, generation, False, len(page) > 1)
+    )
+
+async def handle_history_callback(update: Update, context: ContextTypes, topic_id) -> None:
+    """Handle history paging and resend."""
+    query = update.callback_query
+    user_id = query.from_user.id
+    lang = get_user_language(user_id)
+    
+    try:
+        _, action, rest = query.data.split("_", 2)
+        if action == "send":
+            generation_id = int(rest)
+        else:
+            created_at, generation_id = rest.rsplit("_", 1)
+            cursor = (float(created_at), int(generation_id))
+    except ValueError:
+        logger.warning(f"Invalid history callback from user {user_id}: {query.data}")
+        return
+    
+    if action == "send":
+        generation = await asyncio.get_running_loop().run_in_executor(None, get_generation, user_id, generation_id)
+        if not generation:
+            await query.message.reply_text(lang["history_not_found"])
+            return
+        photo = generation["file_id"] or generation["image_url"]
+        caption = history_caption(lang, generation)
+        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("Download Image 💾", url=generation["image_url"])]])
+        await query.message.reply_photo(photo=photo, caption=caption, reply_markup=keyboard)
+        send_to_topic(context, topic_id, photo=photo, caption=caption, reply_markup=keyboard)
+        return
+    
+    newer = action == "new"
+    page = await asyncio.get_running_loop().run_in_executor(None, get_generation_page, user_id, cursor, newer)
+    if not page:
+        await query.message.reply_text(lang["history_not_found"])
+        return
+    
+    generation = page[0]
+    has_more = len(page) > 1
+    await query.message.edit_media(
+        InputMediaPhoto(
+            media=generation["file_id"] or generation["image_url"],
+            caption=history_caption(lang, generation)
+        ),
+        reply_markup=history_keyboard(
+            lang,
+            generation,
+            has_newer=has_more if newer else True,
+            has_older=True if newer else has_more
+        )
+    )
 
 async def handle_message(update: Update, context: ContextTypes) -> None:
     """Handle messages."""
@@ -480,7 +931,7 @@ async def handle_message(update: Update, context: ContextTypes) -> None:
     manage_user_data(user_id)  # Ensure user is in db
     topic_id = await create_user_topic(update.effective_user, context)
     
-    await forward_to_topic(update, context, topic_id)
+    forward_to_topic(update, context, topic_id)
     
     if user_id not in USER_STATE or USER_STATE[user_id] != STATE_PROMPT:
         return
@@ -500,7 +951,7 @@ async def handle_message(update: Update, context: ContextTypes) -> None:
         lang["dimension"],
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
-    await send_to_topic(context, topic_id, text=lang["dimension"], reply_markup=InlineKeyboardMarkup(keyboard))
+    send_to_topic(context, topic_id, text=lang["dimension"], reply_markup=InlineKeyboardMarkup(keyboard))
 
 async def handle_callback_query(update: Update, context: ContextTypes) -> None:
     """Handle callbacks."""
@@ -518,9 +969,13 @@ async def handle_callback_query(update: Update, context: ContextTypes) -> None:
         await handle_broadcast_callback(update, context)
         return
     
+    if query.data.startswith("hist_"):
+        await handle_history_callback(update, context, topic_id)
+        return
+    
     if query.data.startswith("dim_"):
         dimension = query.data.split("_")[1]
-        await send_to_topic(context, topic_id, text=f"Selected dimension: {dimension}")
+        send_to_topic(context, topic_id, text=f"Selected dimension: {dimension}")
         context.user_data["dimension"] = dimension
         USER_STATE[user_id] = STATE_IMPROVE
         keyboard = [
@@ -536,16 +991,16 @@ async def handle_callback_query(update: Update, context: ContextTypes) -> None:
     
     if query.data.startswith("imp_"):
         improve = query.data.split("_")[1] == "true"
-        await send_to_topic(context, topic_id, text=f"Selected improve: {improve}")
+        send_to_topic(context, topic_id, text=f"Selected improve: {improve}")
         context.user_data["improve"] = improve
-        del USER_STATE[user_id]
+        USER_STATE.pop(user_id, None)
         
         prompt = context.user_data.get("prompt")
         dimension = context.user_data.get("dimension")
         
         manage_user_data(user_id, update_usage=user_data["usage_count"] + 1)
         generating_message = await query.message.edit_text(lang["generating"])
-        await send_to_topic(context, topic_id, text=lang["generating"])
+        send_to_topic(context, topic_id, text=lang["generating"])
         
         try:
             start_time = time.time()
@@ -565,7 +1020,7 @@ async def handle_callback_query(update: Update, context: ContextTypes) -> None:
                     logger.warning(f"API retry {attempt + 1}/3 failed for user {user_id}: {e}")
                     if attempt == 2:
                         await query.message.reply_text(lang["error"].format("Image generation unavailable"))
-                        await send_to_topic(context, topic_id, text=lang["error"].format("Image generation unavailable"))
+                        send_to_topic(context, topic_id, text=lang["error"].format("Image generation unavailable"))
                         await generating_message.delete()
                         return
                     await asyncio.sleep(1)
@@ -580,7 +1035,7 @@ async def handle_callback_query(update: Update, context: ContextTypes) -> None:
             
             if not image_url:
                 await query.message.reply_text(lang["error"].format("No image URL"))
-                await send_to_topic(context, topic_id, text=lang["error"].format("No image URL"))
+                send_to_topic(context, topic_id, text=lang["error"].format("No image URL"))
                 await generating_message.delete()
                 return
             
@@ -597,22 +1052,24 @@ async def handle_callback_query(update: Update, context: ContextTypes) -> None:
                 keyboard = [[InlineKeyboardButton("Download Image 💾", url=image_url)]]
                 success_message = lang["success"].format(prompt, time_taken, image_size)
                 
-                await query.message.reply_photo(
+                photo_message = await query.message.reply_photo(
                     photo=image_url,
                     caption=success_message,
                     reply_markup=InlineKeyboardMarkup(keyboard)
                 )
-                await send_to_topic(context, topic_id, photo=image_url, caption=success_message, reply_markup=InlineKeyboardMarkup(keyboard))
+                file_id = photo_message.photo[-1].file_id if photo_message.photo else None
+                record_generation(user_id, prompt, improve, dimension, image_url, file_id, image_size)
+                send_to_topic(context, topic_id, photo=image_url, caption=success_message, reply_markup=InlineKeyboardMarkup(keyboard))
             else:
                 await query.message.reply_text(lang["invalid_image_url"])
-                await send_to_topic(context, topic_id, text=lang["invalid_image_url"])
+                send_to_topic(context, topic_id, text=lang["invalid_image_url"])
             
             await generating_message.delete()
         
         except Exception as e:
             logger.error(f"Image generation error for user {user_id}: {e}")
             await query.message.reply_text(lang["error"].format("Unexpected error"))
-            await send_to_topic(context, topic_id, text=lang["error"].format("Unexpected error"))
+            send_to_topic(context, topic_id, text=lang["error"].format("Unexpected error"))
             await generating_message.delete()
 
 async def handle_admin_message_in_topic(update: Update, context: ContextTypes) -> None:
@@ -655,6 +1112,134 @@ def estimate_image_size(image_url):
         logger.error(f"Image size estimation error: {e}")
         return 0
 
+def format_stack(frame):
+    """Format a frame's stack as a collapsed-stack line (root first), without source lookups."""
+    entries = []
+    while frame is not None:
+        code = frame.f_code
+        entries.append(f"{Path(code.co_filename).name}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ";".join(reversed(entries))
+
+def watch_event_loop():
+    """Watchdog thread: log the loop thread's stack when the heartbeat stalls."""
+    while True:
+        time.sleep(CONFIG["LOOP_STALL_THRESHOLD"] / 4)
+        expected_wake = LOOP_STATE["expected_wake"]
+        thread_id = LOOP_STATE["thread_id"]
+        if expected_wake is None or LOOP_STATE["reported"] == expected_wake:
+            continue
+        lag = time.monotonic() - expected_wake
+        if lag < CONFIG["LOOP_STALL_THRESHOLD"]:
+            continue
+        frame = sys._current_frames().get(thread_id)
+        if frame is None:
+            continue
+        LOOP_STATE["reported"] = expected_wake
+        stack = "".join(traceback.format_stack(frame))
+        logger.warning(f"Event loop blocked for {lag:.2f}s, stack:\n{stack}")
+
+async def monitor_event_loop():
+    """Measure event loop lag and keep the watchdog heartbeat fresh."""
+    LOOP_STATE["thread_id"] = get_ident()
+    interval = CONFIG["LOOP_LAG_INTERVAL"]
+    while True:
+        LOOP_STATE["expected_wake"] = time.monotonic() + interval
+        await asyncio.sleep(interval)
+        lag = time.monotonic() - LOOP_STATE["expected_wake"]
+        LOOP_STATE["lag"] = lag
+        LOOP_STATE["max_lag"] = max(LOOP_STATE["max_lag"], lag)
+        if lag >= CONFIG["LOOP_STALL_THRESHOLD"]:
+            LOOP_STATE["stalls"] += 1
+            logger.warning(f"Event loop lag {lag:.2f}s (stall #{LOOP_STATE['stalls']})")
+
+def loop_stats():
+    """Return event loop lag measurements for monitoring."""
+    return {
+        "lag": round(LOOP_STATE["lag"], 4),
+        "max_lag": round(LOOP_STATE["max_lag"], 4),
+        "stalls": LOOP_STATE["stalls"]
+    }
+
+def profile_event_loop(seconds):
+    """Sample the event loop thread for N seconds and return collapsed stacks, or None if busy."""
+    if not PROFILE_LOCK.acquire(blocking=False):
+        return None
+    try:
+        thread_id = LOOP_STATE["thread_id"]
+        samples = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                samples[format_stack(frame)] += 1
+            time.sleep(CONFIG["PROFILE_SAMPLE_INTERVAL"])
+        logger.info(f"Profiled event loop for {seconds}s: {sum(samples.values())} samples")
+        return "\n".join(f"{stack} {count}" for stack, count in samples.most_common())
+    finally:
+        PROFILE_LOCK.release()
+
+def parse_profile_seconds(value):
+    """Parse and clamp a profile duration, or return None if invalid."""
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        return None
+    if seconds <= 0:
+        return None
+    return min(seconds, CONFIG["PROFILE_MAX_SECONDS"])
+
+async def profile_command(update: Update, context: ContextTypes) -> None:
+    """Handle /profile [seconds] to sample the event loop and send collapsed stacks (admin only)."""
+    user_id = update.effective_user.id
+    lang = get_user_language(user_id)
+    
+    if user_id != CONFIG["ADMIN_ID"]:
+        await update.message.reply_text(lang["admin_only"])
+        return
+    
+    seconds = parse_profile_seconds(context.args[0] if context.args else 10)
+    if seconds is None:
+        await update.message.reply_text(lang["profile_error"])
+        return
+    
+    await update.message.reply_text(lang["profile_started"].format(seconds))
+    report = await asyncio.get_running_loop().run_in_executor(None, profile_event_loop, seconds)
+    if report is None:
+        await update.message.reply_text(lang["profile_busy"])
+        return
+    
+    num_samples = sum(int(line.rsplit(" ", 1)[1]) for line in report.splitlines())
+    try:
+        await context.bot.send_document(
+            chat_id=user_id,
+            document=report.encode("utf-8"),
+            filename="profile.folded",
+            caption=lang["profile_done"].format(num_samples, seconds)
+        )
+    except Exception as e:
+        logger.error(f"Error sending profile: {e}")
+        await update.message.reply_text(lang["error"].format("Failed to send profile"))
+
+async def post_init(application: Application) -> None:
+    """Start event loop monitoring and the history flusher once the application loop is running."""
+    loop = asyncio.get_running_loop()
+    PERIODIC_TASKS.add(loop.create_task(monitor_event_loop()))
+    Thread(target=watch_event_loop, daemon=True).start()
+    PERIODIC_TASKS.add(loop.create_task(flush_generations_periodically()))
+
+async def post_stop(application: Application) -> None:
+    """Stop periodic tasks, write queued generations, then cancel mirrors and broadcasts still waiting on send budgets."""
+    for task in PERIODIC_TASKS:
+        task.cancel()
+    await asyncio.gather(*PERIODIC_TASKS, return_exceptions=True)
+    PERIODIC_TASKS.clear()
+    await asyncio.get_running_loop().run_in_executor(None, flush_generations)
+    for task in list(BACKGROUND_SENDS):
+        task.cancel()
+    if BACKGROUND_SENDS:
+        logger.info(f"Cancelled {len(BACKGROUND_SENDS)} pending background sends")
+
 async def error_handler(update: Update, context: ContextTypes) -> None:
     """Handle errors."""
     error = context.error
@@ -664,14 +1249,51 @@ async def error_handler(update: Update, context: ContextTypes) -> None:
 
 class HealthCheckHandler(SimpleHTTPRequestHandler):
     def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/profile":
+            self.send_profile(parse_qs(url.query), self.headers.get("X-Profile-Token"))
+            return
+        if url.path == "/stats":
+            self.send_stats()
+            return
         self.send_response(200)
         self.send_header("Content-type", "text/html")
         self.end_headers()
         self.wfile.write(b"Hello World!")
 
+    def send_stats(self):
+        """Serve send scheduler and event loop stats as JSON."""
+        body = json.dumps({"send": SEND_SCHEDULER.stats(), "loop": loop_stats()}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_profile(self, query, request_token):
+        """Serve /profile?seconds=<N> as collapsed stacks; the token comes in an X-Profile-Token header so it stays out of request logs."""
+        token = CONFIG["PROFILE_TOKEN"]
+        if not token or request_token != token:
+            self.send_error(404)
+            return
+        seconds = parse_profile_seconds(query.get("seconds", [10])[0])
+        if seconds is None:
+            self.send_error(400, "Invalid seconds")
+            return
+        report = profile_event_loop(seconds)
+        if report is None:
+            self.send_error(409, "Profile already running")
+            return
+        body = report.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
 def run_http_server():
     PORT = int(os.environ.get('PORT', 8000))
-    with socketserver.TCPServer(("", PORT), HealthCheckHandler) as httpd:
+    with socketserver.ThreadingTCPServer(("", PORT), HealthCheckHandler, bind_and_activate=False) as httpd:
         httpd.allow_reuse_address = True
         httpd.server_bind()
         httpd.server_activate()
@@ -692,12 +1314,14 @@ def main():
     asyncio.set_event_loop(loop)
     
     try:
-        application = Application.builder().token(CONFIG["BOT_TOKEN"]).build()
+        application = Application.builder().token(CONFIG["BOT_TOKEN"]).rate_limiter(SEND_SCHEDULER).post_init(post_init).post_stop(post_stop).concurrent_updates(True).build()
         
         application.add_handler(CommandHandler("start", start_command))
         application.add_handler(CommandHandler("gen", gen_command))
+        application.add_handler(CommandHandler("history", history_command))
         application.add_handler(CommandHandler("users", users_command))
         application.add_handler(CommandHandler("bro", broadcast_command))
+        application.add_handler(CommandHandler("profile", profile_command, block=False))
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, handle_message))
         application.add_handler(CallbackQueryHandler(handle_callback_query))
         application.add_handler(MessageHandler(filters.Chat(CONFIG["GROUP_CHAT_ID"]) & filters.User(CONFIG["ADMIN_ID"]), handle_admin_message_in_topic))